@@ -1,5 +1,8 @@
+import math
 import struct
 import numpy as np
+from numba import njit
+from scipy.spatial.transform import Rotation
 from PIL import Image, ExifTags
 
 """ 
@@ -65,6 +68,8 @@ HEADERS = {
 }
 key_list = list(HEADERS.keys())
 val_list = list(HEADERS.values())
+val_pos = {val: pos for pos, val in enumerate(val_list)}
+full_mask = (1 << len(HEADERS)) - 1 # bit mask with every header found
 
 # Empty dict of fields contained in DJI Phatom 4 MakerNotes field
 VALUES = {
@@ -81,6 +86,20 @@ VALUES = {
     'CAMERA_ROLL': None
 }
 
+# Dict of data types used in DJI Phatom 4 MakerNotes field,
+# mapping the type id to the numpy dtype and a converter for the read items
+TYPES = {
+    0x01: (np.uint8, lambda data: ()),                                # pad
+    0x02: ('S1', lambda data: ' '.join([d.decode() for d in data])),  # char
+    0x0b: ('<f4', lambda data: float(data[-1]))                       # float
+}
+
+# Fixed layout of the DJI Phatom 4 MakerNotes field (see offsets above): the number of fields,
+# then the tag ID, data type, number of items and 4 byte value of each field
+LAYOUT = struct.Struct('<H' + 'HHL4s' * 2 + 'HHLf' * 9)
+LAYOUT_HEADERS = ((HEADERS['MAKE'], 0x02, 4), (HEADERS['UNKNOWN'], 0x01, 4)) + tuple(
+    (tag, 0x0b, 1) for tag in val_list[2:])
+
 def read_makerNotes(makerNotes, values=VALUES, i=0, starting_header=val_list[0]):
     """Read the maker notes into a python dict
 
@@ -97,38 +116,51 @@ def read_makerNotes(makerNotes, values=VALUES, i=0, starting_header=val_list[0])
         values (dict): values read from MakerNotes byte array
     """
     nextHeader = starting_header
+    found = (1 << val_pos[starting_header]) - 1 # headers before the starting header are already read
     while True:
         if makerNotes[i] == nextHeader:
-            pos = val_list.index(nextHeader)
+            pos = val_pos[nextHeader]
             header = key_list[pos]
             print(f'found header {hex(int(makerNotes[i]))} ({header}) at position {i}')
             type = makerNotes[i+2] # read data type
             num = int(struct.unpack(b"<L", makerNotes[i+4:i+8])[0]) # read num of occurances
-            dataType = b"<"
-            if type == 0x01:     # pad
-                dataType = dataType + (b"x" * num)
-                size = num * 1
-                data = struct.unpack(dataType, makerNotes[i+8:i+8+size])
-            elif type == 0x02:  # char
-                dataType = dataType + (b"c" * num)
-                size = num * 1
-                data = struct.unpack(dataType, makerNotes[i+8:i+8+size])
-                data = ' '.join([d.decode() for d in data])[:-1]
-            elif type == 0x0b:  # float
-                dataType = dataType + (b"f" * num)
-                size = num * 4
-                data = struct.unpack(dataType, makerNotes[i+8:i+8+size])[num-1]
-            else:
+            if type not in TYPES:
                 raise ValueError(f'cannot identify type with hexadecimal representation: {type}')
-            values[header] = data
+            dtype, convert = TYPES[type]
+            size = num * np.dtype(dtype).itemsize
+            data = np.frombuffer(makerNotes, dtype=dtype, count=num, offset=i+8)
+            values[header] = convert(data)
             i = i + 8 + size - 1
             nextHeader += 1
-            sumNones = sum([1 for key, val in values.items() if val is None])
-            if sumNones == 0:
+            found |= 1 << pos
+            if found == full_mask:
                 break
         i+=1
     return values
 
+def read_makerNotes_fast(makerNotes):
+    """Read the maker notes into a python dict, using the fixed layout of DJI Phatom 4 images
+
+    The whole field is unpacked at the known offsets with a single struct call,
+    falling back to scanning with read_makerNotes if the field does not match the layout.
+
+    Args:
+        makerNotes (byte str): byte string from the MakerNotes exif field
+
+    Returns:
+        values (dict): values read from MakerNotes byte array
+    """
+    if len(makerNotes) >= LAYOUT.size:
+        fields = LAYOUT.unpack_from(makerNotes)
+        headers = tuple(fields[k:k+3] for k in range(1, len(fields), 4))
+        if headers == LAYOUT_HEADERS:
+            values = dict(zip(key_list, fields[4::4]))
+            for key, (_, type, _) in zip(key_list[:2], headers): # convert the byte string values
+                dtype, convert = TYPES[type]
+                values[key] = convert(np.frombuffer(values[key], dtype=dtype))
+            return values
+    return read_makerNotes(makerNotes, values=dict.fromkeys(VALUES))
+
 def get_makerNotes(img, field_name='MakerNote'):
     """Gets the makerNotes field from the jpg exif data
 
@@ -148,60 +180,77 @@ def get_makerNotes(img, field_name='MakerNote'):
     return MakerNote
 
 def euler2rot(R, P, Y):
-    Rx = np.array([[ 1, 0, 0],
-                   [ 0, np.cos(R),-np.sin(R)],
-                   [ 0, np.sin(R), np.cos(R)]])
+    # closed form of Rz(Y).Ry(P).Rx(R)
+    cR, sR = math.cos(R), math.sin(R)
+    cP, sP = math.cos(P), math.sin(P)
+    cY, sY = math.cos(Y), math.sin(Y)
+    return np.array([[ cY*cP, cY*sP*sR - sY*cR, cY*sP*cR + sY*sR],
+                     [ sY*cP, sY*sP*sR + cY*cR, sY*sP*cR - cY*sR],
+                     [-sP,    cP*sR,            cP*cR]])
 
-    Ry = np.array([[ np.cos(P), 0, np.sin(P)],
-                   [ 0, 1, 0],
-                   [-np.sin(P), 0, np.cos(P)]])
+def euler2rots(rpy):
+    """Convert roll, pitch, yaw angles of several orientations to rotation matrices
 
-    Rz = np.array([[ np.cos(Y), -np.sin(Y), 0],
-                   [ np.sin(Y), np.cos(Y) , 0],
-                   [ 0, 0, 1]])
-    return Rz.dot(Ry.dot(Rx))
+    Args:
+        rpy (np array): (N, 3) array of roll, pitch, yaw angles in radians
+
+    Returns:
+        np array: (N, 3, 3) array of Rz(Y).Ry(P).Rx(R) rotation matrices
+    """
+    return Rotation.from_euler('xyz', rpy).as_matrix()
 
+@njit(cache=True)
 def isRotationMatrix(rot) :
-    rot_t = np.transpose(rot)
-    shouldBeIdentity = np.dot(rot_t, rot)
-    I = np.identity(3, dtype = rot.dtype)
-    n = np.linalg.norm(I - shouldBeIdentity)
-    return n < 1e-6
+    # frobenius norm of I - rot.T.rot, computed element wise
+    n = 0.0
+    for i in range(3):
+        for j in range(3):
+            d = rot[0,i] * rot[0,j] + rot[1,i] * rot[1,j] + rot[2,i] * rot[2,j]
+            if i == j:
+                d -= 1.0
+            n += d * d
+    return math.sqrt(n) < 1e-6
 
+@njit(cache=True)
 def rot2euler(rot) :
     assert(isRotationMatrix(rot))
-    sy = np.sqrt(rot[0,0] * rot[0,0] +  rot[1,0] * rot[1,0])
+    sy = math.sqrt(rot[0,0] * rot[0,0] +  rot[1,0] * rot[1,0])
     singular = sy < 1e-6
     if  not singular:
-        r = np.arctan2(rot[2,1] , rot[2,2])
-        p = np.arctan2(-rot[2,0], sy)
-        y = np.arctan2(rot[1,0], rot[0,0])
+        r = math.atan2(rot[2,1] , rot[2,2])
+        p = math.atan2(-rot[2,0], sy)
+        y = math.atan2(rot[1,0], rot[0,0])
     else:
-        r = np.arctan2(-rot[1,2], rot[1,1])
-        p = np.arctan2(-rot[2,0], sy)
-        y = 0
+        r = math.atan2(-rot[1,2], rot[1,1])
+        p = math.atan2(-rot[2,0], sy)
+        y = 0.0
     return np.array([r, p, y])
 
 if __name__ == '__main__':
-    from tkinter.filedialog import askopenfilename
+    from tkinter.filedialog import askopenfilenames
     from tkinter import Tk
     root = Tk()
     root.withdraw()
-    filename = askopenfilename(filetypes=(("jpg files", "*.jpg"), ("All files", "*.*")), title='select a jpg image')
+    filenames = askopenfilenames(filetypes=(("jpg files", "*.jpg"), ("All files", "*.*")), title='select jpg images')
 
-    img = Image.open(filename)
-    MakerNote = get_makerNotes(img) # Retrieves the MakerNotes binary string
-    values = read_makerNotes(MakerNote) # reads the MakerNotes binary string into a python dict
-    print('values read from MakerNotes field: ', values)
+    # form roll, pitch yaw array of the craft and camera for all images
+    rpy = np.empty((len(filenames), 6))
+    for n, filename in enumerate(filenames):
+        img = Image.open(filename)
+        MakerNote = get_makerNotes(img) # Retrieves the MakerNotes binary string
+        values = read_makerNotes_fast(MakerNote) # reads the MakerNotes binary string into a python dict
+        print(f'values read from MakerNotes field of {filename}: ', values)
+        rpy[n] = [values['ROLL'], values['PITCH'], values['YAW'],
+                  values['CAMERA_ROLL'], values['CAMERA_PITCH'] + 90, values['CAMERA_YAW']]
+    rpy[:, [2, 5]] = np.mod(rpy[:, [2, 5]], 360)
+    rpy *= np.pi / 180.0
+    craft_rpy = rpy[:, 0:3]
+    camera_rpy = rpy[:, 3:6]
 
-    # form roll, pitch yaw array
-    craft_rpy = np.array([values['ROLL'], values['PITCH'], values['YAW'] % 360]) * np.pi / 180.0
-    camera_rpy = np.array([values['CAMERA_ROLL'], values['CAMERA_PITCH'] + 90, values['CAMERA_YAW'] % 360]) * np.pi / 180.0
+    # convert to rotation matrices
+    craft_rot = euler2rots(craft_rpy)
+    camera_rot = euler2rots(camera_rpy)
 
-    # convert to rotation matrix
-    craft_rot = euler2rot(craft_rpy[0], craft_rpy[1], craft_rpy[2])
-    camera_rot = euler2rot(camera_rpy[0], camera_rpy[1], camera_rpy[2])
-    
     #rot = np.matmul(camera_rot, craft_rot) # combine craft and camera rotation
     #rpy = rot2euler(camera_rot) * 180 / np.pi
     print('craft rpy is: ', craft_rpy * 180 / np.pi)
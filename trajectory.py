@@ -1,12 +1,52 @@
 import os
+import functools
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import numpy as np
+from numba import njit, prange
 from pyproj import CRS
 from pyproj import Transformer
 from tkinter import Tk
 from tkinter.filedialog import askopenfilename
 from tkinter.filedialog import askopenfilenames
 
+# Columns and data types of the rtklib '.pos' file
+POS_DTYPES = {
+    "week": "int16",
+    "GPST": "float64",
+    "lat": "float64",
+    "lon": "float64",
+    "height": "float64",
+    "Q": "int8",
+    "ns": "int16",
+    "sdn": "float64",
+    "sde": "float64",
+    "sdu": "float64",
+    "sdne": "float64",
+    "sdeu": "float64",
+    "sdun": "float64",
+    "age": "float64",
+    "ratio": "float64",
+}
+
+# Columns and data types used from the inclination '.txt' file
+ORIENT_DTYPES = {
+    "#Label": "str",
+    "Yaw": "float64",
+    "Roll": "float64",
+    "Pitch": "float64",
+}
+
+# Columns and data types used from the image timestamp '.MRK' file,
+# lever arm columns carry a direction suffix (e.g. "12,N") and are cleaned later
+TIME_DTYPES = {
+    "photoID": "int32",
+    "GPST": "float64",
+    "leverN": "str",
+    "leverE": "str",
+    "leverD": "str",
+}
+
 
 def open_file(filetype, title):
     root = Tk()
@@ -23,24 +63,44 @@ def open_files(filetype, title):
 
 
 def stats(df):
-    fix_percent = df["Q"].value_counts(sort=True, normalize=True)
-    if 1 in fix_percent.index:
+    fix_counts = np.bincount(df["Q"].to_numpy(), minlength=2)
+    if fix_counts[1] > 0:
         print(
-            "{:.2f}% of measurements had fixed ambiguities".format(fix_percent[1] * 100)
+            "{:.2f}% of measurements had fixed ambiguities".format(
+                fix_counts[1] / len(df) * 100
+            )
         )
     else:
         print("0% of measurements had fixed ambiguities")
 
+    means = df[["sdn", "sde", "sdu", "ns"]].to_numpy(np.float64).mean(axis=0)
+    sdn, sde, sdu, ns = means
     print(
         "Average standard deviation estimates of position components are:\n"
         "Northing: {:.3f}\n"
         "Easting: {:.3f}\n"
-        "Height: {:.3f}".format(df["sdn"].mean(), df["sde"].mean(), df["sdu"].mean())
+        "Height: {:.3f}".format(sdn, sde, sdu)
     )
-    print("average number of satellites used was: {:.2f}".format(df["ns"].mean()))
+    print("average number of satellites used was: {:.2f}".format(ns))
+
+
+@functools.lru_cache(maxsize=8)
+def _get_transformer(proj_in, proj_out):
+    """Build (and cache) the transformer between two coordinate systems
+
+    Parameters:
+        proj_in (int): epsg code of input coordinate system
+        proj_out (int): epsg code of output coordinate system
+
+    Returns:
+        (pyproj.Transformer): transformer from proj_in to proj_out
+    """
+    geodetic = CRS.from_epsg(proj_in)
+    projected = CRS.from_epsg(proj_out)
+    return Transformer.from_crs(geodetic, projected, always_xy=False)
 
 
-def geodeticToProj(lat, lon, ellip, proj_out, proj_in=6319):
+def geodeticToProj(lat, lon, ellip, proj_out, proj_in=6319, transformer=None):
     """Convert geodetic coordinates to projected coordinate system
 
     Parameters:
@@ -49,35 +109,119 @@ def geodeticToProj(lat, lon, ellip, proj_out, proj_in=6319):
         ellip (np.height): ellipsoid heights
         proj_out (int): epsg code of output projected coordinate system
         proj_in (int): epsg code of input geodetic coordinate system, defaults to NAD83 (2011)
+        transformer (pyproj.Transformer, optional): transformer to use, defaults to a cached
+            transformer from proj_in to proj_out
 
     Returns:
         tuple: X, Y, Z of projected coordinate system
     """
 
     # Define transformation parameters
-    geodetic = CRS.from_epsg(proj_in)
-    projected = CRS.from_epsg(proj_out)
-    transformer = Transformer.from_crs(geodetic, projected)
+    if transformer is None:
+        transformer = _get_transformer(proj_in, proj_out)
 
     # Transform coordinates
-    return transformer.transform(lat, lon, ellip)
+    lat = np.ascontiguousarray(lat, dtype=np.float64)
+    lon = np.ascontiguousarray(lon, dtype=np.float64)
+    ellip = np.ascontiguousarray(ellip, dtype=np.float64)
+    return transformer.transform(lat, lon, ellip, radians=False)
+
+
+def readGeoid(model):
+    """Reads a NGS GEOID12B binary grid file into a bicubic spline interpolator
+
+    Parameters:
+        model (str): path to geoid model file to use
 
+    Returns:
+        (scipy.interpolate.RectBivariateSpline) geoid heights interpolator, evaluated
+            with latitudes and 0-360 east longitudes
+    """
+    from scipy.interpolate import RectBivariateSpline
+
+    header = np.dtype(
+        [
+            ("lat0", "f8"),
+            ("lon0", "f8"),
+            ("dlat", "f8"),
+            ("dlon", "f8"),
+            ("nlat", "i4"),
+            ("nlon", "i4"),
+            ("ikind", "i4"),
+        ]
+    )
 
-def applyGeoid(lat, lon, ellip, model):
+    # Grids are distributed in either byte order, ikind is always 1
+    for byteorder in ("<", ">"):
+        info = np.fromfile(model, dtype=header.newbyteorder(byteorder), count=1)[0]
+        if info["ikind"] == 1:
+            break
+    else:
+        raise ValueError(f"cannot identify geoid file format of {model}")
+
+    grid = np.memmap(
+        model,
+        dtype=byteorder + "f4",
+        mode="r",
+        offset=header.itemsize,
+        shape=(info["nlat"], info["nlon"]),
+    )
+
+    lats = info["lat0"] + np.arange(info["nlat"]) * info["dlat"]
+    lons = info["lon0"] + np.arange(info["nlon"]) * info["dlon"]
+    bbox = [lats[0], lats[-1], lons[0], lons[-1] + info["dlon"]]
+    return RectBivariateSpline(lats, lons, grid, bbox=bbox, kx=3, ky=3, s=0)
+
+
+def applyGeoid(lat, lon, ellip, geoid):
     """Converts ellipsoid height to orthometric height
 
     Parameters:
         lat (np array): latitudes
         lon (np array): longitudes
         ellip (np array): ellipsoid heights
-        model (str): path to geoid model file to use
+        geoid (scipy.interpolate.RectBivariateSpline): geoid model to use, see readGeoid
 
     Returns:
         (np array) orthometric heights"""
-    import pygeodesy as pg
 
-    geoid = pg.GeoidG2012B(model)
-    return ellip - geoid.height(lat, lon)
+    # Evaluate all coordinates in one call, grid longitudes are 0-360 east
+    lat = np.asarray(lat)
+    lon = np.asarray(lon) % 360
+    lat_knots, lon_knots = geoid.get_knots()
+    if np.any((lat < lat_knots[0]) | (lat > lat_knots[-1])) or np.any(
+        (lon < lon_knots[0]) | (lon > lon_knots[-1])
+    ):
+        raise ValueError("coordinates are outside of the geoid model extent")
+
+    return ellip - geoid.ev(lat, lon)
+
+
+@njit(parallel=True, cache=True)
+def _interpolate(query, ref, values, out):
+    """Linear interpolation of all columns of values at the query times, in parallel.
+
+    Like np.interp, ref must be increasing and query times outside of ref are
+    clamped to the end points.
+    """
+    n = ref.shape[0]
+    for q in prange(query.shape[0]):
+        t = query[q]
+
+        # Bisect for the first reference time >= t
+        lo, hi = 0, n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if ref[mid] < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        idx = min(max(lo, 1), n - 1)
+
+        w = (t - ref[idx - 1]) / (ref[idx] - ref[idx - 1])
+        w = min(max(w, 0.0), 1.0)
+        for c in range(values.shape[1]):
+            out[q, c] = values[idx - 1, c] + (values[idx, c] - values[idx - 1, c]) * w
 
 
 def interpolatePosition(pos, mrk):
@@ -91,12 +235,15 @@ def interpolatePosition(pos, mrk):
         (pd.dataframe): dataframe of interpoloated camera coordinates
     """
 
-    mrk["X"] = np.interp(mrk["GPST"], pos["GPST"], pos["X"])
-    mrk["Y"] = np.interp(mrk["GPST"], pos["GPST"], pos["Y"])
-    mrk["Z"] = np.interp(mrk["GPST"], pos["GPST"], pos["Z"])
-    mrk["sde"] = np.interp(mrk["GPST"], pos["GPST"], pos["sde"])
-    mrk["sdn"] = np.interp(mrk["GPST"], pos["GPST"], pos["sdn"])
-    mrk["sdu"] = np.interp(mrk["GPST"], pos["GPST"], pos["sdu"])
+    columns = ["X", "Y", "Z", "sde", "sdn", "sdu"]
+    pos_gpst = np.ascontiguousarray(pos["GPST"].to_numpy(dtype=np.float64))
+    mrk_gpst = np.ascontiguousarray(mrk["GPST"].to_numpy(dtype=np.float64))
+    values = np.ascontiguousarray(pos[columns].to_numpy(dtype=np.float64))
+
+    interpolated = np.empty((len(mrk_gpst), len(columns)))
+    _interpolate(mrk_gpst, pos_gpst, values, interpolated)
+    for column, value in zip(columns, interpolated.T):
+        mrk[column] = value
 
     return mrk
 
@@ -115,11 +262,80 @@ def leverArm(df):
         (pd.dataframe): dataframe of corrected camera positions
     """
 
-    df["X"] = df["X"] + df["leverE"] / 1000
-    df["Y"] = df["Y"] + df["leverN"] / 1000
-    df["Z"] = df["Z"] - df["leverD"] / 1000
+    lever = df[["leverE", "leverN", "leverD"]].to_numpy()
+    df[["X", "Y", "Z"]] = df[["X", "Y", "Z"]].to_numpy() + lever / [1000, 1000, -1000]
     return df
 
+
+def readPos(rtklib_file):
+    """Reads the rtklib trajectory
+
+    Parameters:
+        rtklib_file (str): path to rtklib '.pos' file
+
+    Returns:
+        (pd.dataframe): dataframe containing the trajectory
+    """
+    return pd.read_csv(
+        rtklib_file,
+        sep=",",
+        skiprows=1,
+        names=list(POS_DTYPES),
+        dtype=POS_DTYPES,
+        header=0,
+        index_col=False,
+        engine="c",
+    )
+
+
+def readOrient(orient_file):
+    """Reads the camera rotations
+
+    Parameters:
+        orient_file (str): path to inclination '.txt' file
+
+    Returns:
+        (pd.dataframe): dataframe containing the rotation of each image
+    """
+    return pd.read_csv(
+        orient_file,
+        sep=",",
+        skiprows=1,
+        usecols=list(ORIENT_DTYPES),
+        dtype=ORIENT_DTYPES,
+        header=0,
+        index_col=False,
+        engine="c",
+    )
+
+
+def readTime(time_file):
+    """Reads the image timestamps and lever arm corrections
+
+    Parameters:
+        time_file (str): path to image timestamp '.MRK' file
+
+    Returns:
+        (pd.dataframe): dataframe containing the timestamp of each image
+    """
+    time = pd.read_csv(
+        time_file,
+        sep="\t",
+        usecols=[0, 1, 3, 4, 5],
+        names=list(TIME_DTYPES),
+        dtype=TIME_DTYPES,
+        index_col=False,
+        engine="c",
+    )
+
+    # Remove the direction suffix (",N", ",E", ",V") from lever arm columns
+    levers = ["leverN", "leverE", "leverD"]
+    time[levers] = (
+        time[levers].apply(lambda s: pd.to_numeric(s.str.slice(0, -2))).astype("int32")
+    )
+    return time
+
+
 if __name__ == "__main__":
 
     print("Select the rtklib '.pos' file(s)\n")
@@ -161,8 +377,8 @@ if __name__ == "__main__":
         orient_files = sorted(orient_files)
         time_files = sorted(time_files)
 
-    # Create iterable object of filenames
-    flights = zip(rtklib_files, orient_files, time_files)
+    if numFlights == 0:
+        raise ValueError("no files given, you must enter at least one .pos file")
 
     # Get the output coordinate system
     print(
@@ -180,9 +396,46 @@ if __name__ == "__main__":
         input("Enter a multiplier to scale the standard devation values:\n")
     )
 
+    # Define transformation to the output coordinate system once for all flights
+    transformer = _get_transformer(6319, local_projection)
+
+    # Load the geoid model once for all flights, if given
+    geoid = readGeoid(ortho_model) if len(ortho_model) > 0 else None
+
+    # Read the files of all flights into panda dataframes, in parallel
+    with ThreadPoolExecutor() as executor:
+        pos_list = list(executor.map(readPos, rtklib_files))
+        orient_list = list(executor.map(readOrient, orient_files))
+        time_list = list(executor.map(readTime, time_files))
+
+    # convert to numpy arrays, concatenating all flights
+    lat = np.concatenate([pos["lat"].to_numpy() for pos in pos_list])
+    lon = np.concatenate([pos["lon"].to_numpy() for pos in pos_list])
+    ellip = np.concatenate([pos["height"].to_numpy() for pos in pos_list])
+
+    # Reproject the data of all flights at once
+    X, Y, ellip = geodeticToProj(
+        lat, lon, ellip, local_projection, transformer=transformer
+    )
+
+    # Convert ellipsoid height to ortho height, if geoid model given
+    if geoid is not None:
+        Z = applyGeoid(lat, lon, ellip, geoid)
+        height_msg = "processing with ortho height"
+    else:
+        Z = ellip
+        height_msg = "processing with ellipsoid height"
+
+    # Split the projected coordinates back into flights
+    splits = np.cumsum([len(pos) for pos in pos_list])[:-1]
+    coords = zip(np.split(X, splits), np.split(Y, splits), np.split(Z, splits))
+
+    # Create iterable object of flights
+    flights = zip(rtklib_files, pos_list, orient_list, time_list, coords)
+
     # Iterate through each flight
     for flight in flights:
-        rtklib_file, orient_file, time_file  = flight
+        rtklib_file, pos, orient, time, (X, Y, Z) = flight
 
         # Setup output file and directory
         os.chdir(os.path.dirname(rtklib_file))
@@ -191,71 +444,12 @@ if __name__ == "__main__":
         print(f"\nProcessing file: {output_file}")
         output_file = output_file + "_cameras" + ".txt"
 
-        # Read the files into panda dataframes
-        pos = pd.read_csv(
-            rtklib_file,
-            sep=",",
-            skiprows=1,
-            names=[
-                "week",
-                "GPST",
-                "lat",
-                "lon",
-                "height",
-                "Q",
-                "ns",
-                "sdn",
-                "sde",
-                "sdu",
-                "sdne",
-                "sdeu",
-                "sdun",
-                "age",
-                "ratio",
-            ],
-            header=0,
-            index_col=False,
-        )
-        orient = pd.read_csv(
-            orient_file,
-            sep=",",
-            skiprows=1,
-            usecols=["#Label", "Yaw", "Roll", "Pitch"],
-            header=0,
-            index_col=False,
-        )
-        time = pd.read_csv(
-            time_file,
-            sep="\t",
-            usecols=[0, 1, 3, 4, 5],
-            names=["photoID", "GPST", "leverN", "leverE", "leverD"],
-            index_col=False,
-        )
-
-        # Remove additional characters from lever arm columns
-        time["leverN"] = time["leverN"].map(lambda x: x.rstrip(",N")).astype("int32")
-        time["leverE"] = time["leverE"].map(lambda x: x.rstrip(",E")).astype("int32")
-        time["leverD"] = time["leverD"].map(lambda x: x.rstrip(",V")).astype("int32")
-
         # print stats of rtklib pos file
         # TODO: sort pos file based on GPST column
         stats(pos)
 
-        # convert to numpy arrays
-        lat = pos["lat"].to_numpy()
-        lon = pos["lon"].to_numpy()
-        ellip = pos["height"].to_numpy()
-
-        # Reproject the data
-        pos["X"], pos["Y"], ellip = geodeticToProj(lat, lon, ellip, local_projection)
-
-        # Convert ellipsoid height to ortho height, if geoid model given
-        if len(ortho_model) > 0:
-            pos["Z"] = applyGeoid(lat, lon, ellip, ortho_model)
-            print("processing with ortho height")
-        else:
-            pos["Z"] = ellip
-            print("processing with ellipsoid height")
+        pos["X"], pos["Y"], pos["Z"] = X, Y, Z
+        print(height_msg)
 
         # Remove excess features from Pos dataframe
         pos = pos[["GPST", "X", "Y", "Z", "sde", "sdn", "sdu"]]
@@ -273,14 +467,14 @@ if __name__ == "__main__":
         camera_origin = leverArm(interpol)
 
         # Scale the accuracy values
-        camera_origin["sde"] = camera_origin["sde"] * acc_scale
-        camera_origin["sdn"] = camera_origin["sdn"] * acc_scale
-        camera_origin["sdu"] = camera_origin["sdu"] * acc_scale
+        accuracy = ["sde", "sdn", "sdu"]
+        camera_origin[accuracy] = camera_origin[accuracy].to_numpy() * acc_scale
 
         # Clean up and export
         reorder = ["#Label", "X", "Y", "Z", "Yaw", "Pitch", "Roll", "sde", "sdn", "sdu"]
-        camera_origin = camera_origin[reorder]
-        camera_origin.to_csv(output_file, index=False, float_format="%.5f")
+        camera_origin.to_csv(
+            output_file, columns=reorder, index=False, float_format="%.5f"
+        )
 
         output_msg = os.getcwd() + "\\"+ output_file
         print(f"Success! Output file wrote to {output_msg}\n")